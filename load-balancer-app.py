@@ -1,7 +1,10 @@
 from flask import Flask, jsonify
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 app = Flask(__name__)
@@ -19,12 +22,22 @@ SERVERS = [
     {'name': 'server8', 'url': 'https://4.aimachengine.com', 'weight': 1},
 ]
 
+# Shared pool so all health probes run concurrently instead of one after another
+EXECUTOR = ThreadPoolExecutor(max_workers=len(SERVERS))
+
+# Shared session so connections (and TLS handshakes) are reused between probes
+SESSION = requests.Session()
+_retry = Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=_retry)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
 def check_server_health(server):
     """Check individual server health and calculate score"""
     try:
-        start_time = time.time()
-        response = requests.get(f"{server['url']}/health", timeout=5)
-        response_time = (time.time() - start_time) * 1000  # ms
+        start_ns = time.perf_counter_ns()
+        response = SESSION.get(f"{server['url']}/health", timeout=5)
+        response_time = (time.perf_counter_ns() - start_ns) / 1e6  # ms
         
         if response.status_code == 200:
             health_data = response.json()
@@ -63,11 +76,7 @@ def check_server_health(server):
 
 def get_all_server_health():
     """Get health status for all servers"""
-    server_health = []
-    for server in SERVERS:
-        health_data = check_server_health(server)
-        server_health.append(health_data)
-    return server_health
+    return list(EXECUTOR.map(check_server_health, SERVERS))
 
 def get_highest_score_server():
     """Get the server with the highest score"""
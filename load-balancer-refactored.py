@@ -4,18 +4,29 @@ A high-performance server health monitoring and routing service
 """
 
 import asyncio
+import atexit
+import random
+import socket
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from enum import Enum
 from typing import Dict, List, Optional, Tuple
 from functools import lru_cache
+from itertools import accumulate, count
 import logging
 
 from flask import Flask, jsonify, Response
+from flask.json.provider import JSONProvider
+import orjson
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
 from urllib3.util.retry import Retry
 
 # Configure logging
@@ -44,7 +55,7 @@ class ServerConfig:
         return hash((self.name, self.url))
 
 
-@dataclass
+@dataclass(slots=True)
 class ServerHealth:
     """Server health information data class"""
     name: str
@@ -54,7 +65,17 @@ class ServerHealth:
     score: float
     status_code: Optional[int] = None
     error: Optional[str] = None
-    last_checked: str = field(default_factory=lambda: datetime.now().isoformat())
+    last_checked_epoch: float = field(default_factory=time.time)
+    # JSON encoding of to_dict(), computed once since results are never mutated
+    serialized: bytes = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self.serialized = orjson.dumps(self.to_dict())
+    
+    @property
+    def last_checked(self) -> str:
+        """ISO formatted time of the check"""
+        return datetime.fromtimestamp(self.last_checked_epoch).isoformat()
     
     def to_dict(self) -> Dict:
         """Convert to dictionary for JSON serialization"""
@@ -70,17 +91,111 @@ class ServerHealth:
         }
 
 
+# Seconds resolved backend addresses are reused before DNS is queried again
+DNS_CACHE_TTL = 60
+
+
+@lru_cache(maxsize=256)
+def _resolve(host: str, port: int, ttl_bucket: int) -> Tuple[str, ...]:
+    """Resolve host to its addresses; ttl_bucket rolls over to expire entries"""
+    infos = socket.getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM)
+    return tuple(dict.fromkeys(info[4][0] for info in infos))
+
+
+def resolve_host(host: str, port: int) -> Tuple[str, ...]:
+    """Resolve host through a cache that is refreshed every DNS_CACHE_TTL seconds"""
+    return _resolve(host, port, int(time.monotonic() // DNS_CACHE_TTL))
+
+
+class CachedDNSMixin:
+    """Connect to the cached addresses while TLS and Host headers keep the hostname"""
+    
+    # Rotates the first address tried so round-robin DNS still spreads connections
+    _rotation = count()
+    
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = resolve_host(host, self.port)
+        except OSError:
+            # Let urllib3 resolve it and report the failure
+            return super()._new_conn()
+        
+        start = next(self._rotation) % len(addresses)
+        ordered = addresses[start:] + addresses[:start]
+        try:
+            # Try each address in turn, like socket.create_connection does
+            for address in ordered[:-1]:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError):
+                    continue
+            self._dns_host = ordered[-1]
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class CachedDNSHTTPConnection(CachedDNSMixin, HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(CachedDNSMixin, HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter that keeps backend sockets warm and caches DNS"""
+    
+    SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+    
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('socket_options', self.SOCKET_OPTIONS)
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CachedDNSHTTPConnectionPool,
+            'https': CachedDNSHTTPSConnectionPool,
+        }
+
+
 class HealthChecker:
     """Handles server health checking with caching and connection pooling"""
     
-    def __init__(self, timeout: int = 5, max_retries: int = 2, cache_ttl: int = 10):
+    # Bounds for the adaptive cache TTL (seconds)
+    MIN_CACHE_TTL = 3
+    MAX_CACHE_TTL = 30
+    ERROR_CACHE_TTL = 2
+    
+    def __init__(self, timeout: int = 5, max_retries: int = 2, cache_ttl: float = 2,
+                 max_hosts: int = 20, max_workers: int = 10):
         self.timeout = timeout
         self.cache_ttl = cache_ttl
         self.cache: Dict[str, Tuple[ServerHealth, float]] = {}
-        self.session = self._create_session(max_retries)
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        # Most recent healthy result per URL
+        self.last_good: Dict[str, ServerHealth] = {}
+        self.session = self._create_session(max_retries, max_hosts)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hc-')
+        # One outstanding probe per URL; concurrent callers share its future
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        # Release resources at exit rather than in __del__, which may run
+        # mid-shutdown and kill probes that are still in flight
+        atexit.register(self.session.close)
+        atexit.register(self.executor.shutdown, wait=True)
     
-    def _create_session(self, max_retries: int) -> requests.Session:
+    def _create_session(self, max_retries: int, max_hosts: int) -> requests.Session:
         """Create a requests session with connection pooling and retry logic"""
         session = requests.Session()
         retry_strategy = Retry(
@@ -88,9 +203,12 @@ class HealthChecker:
             backoff_factor=0.3,
             status_forcelist=[429, 500, 502, 503, 504],
         )
-        adapter = HTTPAdapter(
-            pool_connections=20,
-            pool_maxsize=20,
+        # Keep a pool for every backend so none is evicted and re-handshaked.
+        # Probes are coalesced per URL, so one or two sockets per host suffice.
+        adapter = KeepAliveAdapter(
+            pool_connections=max_hosts,
+            pool_maxsize=2,
+            pool_block=False,
             max_retries=retry_strategy
         )
         session.mount("http://", adapter)
@@ -101,36 +219,80 @@ class HealthChecker:
         """Check if cached data is still valid"""
         if server_url not in self.cache:
             return False
-        _, timestamp = self.cache[server_url]
-        return (time.time() - timestamp) < self.cache_ttl
+        _, expires_at = self.cache[server_url]
+        return time.time() < expires_at
+    
+    def _cache_ttl_for(self, health: ServerHealth) -> float:
+        """Cache lifetime for a probe result, longer for slower backends"""
+        if health.health != HealthStatus.HEALTHY or health.response_time is None:
+            # Retry failing servers soon so they recover quickly
+            return self.ERROR_CACHE_TTL
+        ttl = self.cache_ttl + health.response_time / 500
+        return min(self.MAX_CACHE_TTL, max(self.MIN_CACHE_TTL, ttl))
     
     def check_server(self, server: ServerConfig) -> ServerHealth:
         """Check individual server health with caching"""
+        return self._probe(server).result()
+    
+    def _probe(self, server: ServerConfig) -> Future:
+        """Get a future for the server's health, joining any probe already in flight"""
         # Check cache first
         if self._is_cache_valid(server.url):
-            return self.cache[server.url][0]
+            return self._cached_future(server.url)
+        
+        with self._inflight_lock:
+            future = self._inflight.get(server.url)
+            if future is not None:
+                return future
+            # A probe may have finished and released its slot since the check above
+            if self._is_cache_valid(server.url):
+                return self._cached_future(server.url)
+            future = self.executor.submit(self._do_probe, server)
+            self._inflight[server.url] = future
         
+        # Registered outside the lock: the callback runs immediately if the
+        # probe has already finished, and it takes the lock itself
+        future.add_done_callback(lambda f, url=server.url: self._pop_inflight(url, f))
+        return future
+    
+    def _cached_future(self, server_url: str) -> Future:
+        """Wrap the cached health for a URL in a completed future"""
+        future: Future = Future()
+        future.set_result(self.cache[server_url][0])
+        return future
+    
+    def _pop_inflight(self, server_url: str, future: Future) -> None:
+        """Release the in-flight slot for a URL if it still belongs to future"""
+        with self._inflight_lock:
+            if self._inflight.get(server_url) is future:
+                del self._inflight[server_url]
+    
+    def _do_probe(self, server: ServerConfig) -> ServerHealth:
+        """Probe the server's health endpoint and update the cache"""
         try:
-            start_time = time.time()
+            start_ns = time.perf_counter_ns()
             response = self.session.get(
                 f"{server.url}/health",
                 timeout=self.timeout,
                 allow_redirects=False
             )
-            response_time = (time.time() - start_time) * 1000  # ms
+            response_time = (time.perf_counter_ns() - start_ns) / 1e6  # ms
             
             if response.status_code == 200:
                 try:
                     health_data = response.json()
+                    # Coerce to float so out-of-range integers still serialize
+                    score = health_data.get("score")
+                    score = self._calculate_score(response_time) if score is None else float(score)
                     health = ServerHealth(
                         name=server.name,
                         url=server.url,
                         health=HealthStatus.HEALTHY,
                         response_time=round(response_time, 2),
-                        score=health_data.get("score", self._calculate_score(response_time)),
+                        score=score,
                         status_code=response.status_code
                     )
-                except (ValueError, KeyError) as e:
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
                     logger.warning(f"Invalid health response from {server.name}: {e}")
                     health = ServerHealth(
                         name=server.name,
@@ -151,7 +313,9 @@ class HealthChecker:
                     status_code=response.status_code
                 )
                 
-        except requests.RequestException as e:
+        except Exception as e:
+            # Request failures and anything unexpected both mark the server as
+            # errored, so no exception escapes into the probe future
             logger.error(f"Error checking {server.name}: {e}")
             health = ServerHealth(
                 name=server.name,
@@ -162,15 +326,37 @@ class HealthChecker:
                 error=str(e)
             )
         
-        # Update cache
-        self.cache[server.url] = (health, time.time())
+        if health.health == HealthStatus.HEALTHY:
+            self.last_good[server.url] = health
+        
+        # Cached before the done callback releases the in-flight slot, so new
+        # callers hit the cache instead of starting another probe
+        self.cache[server.url] = (health, time.time() + self._cache_ttl_for(health))
         return health
     
-    def check_all_servers_parallel(self, servers: List[ServerConfig]) -> List[ServerHealth]:
-        """Check all servers in parallel"""
-        futures = [self.executor.submit(self.check_server, server) for server in servers]
+    def check_all_servers_parallel(
+        self, servers: List[ServerConfig]
+    ) -> Tuple[List[ServerHealth], Optional[ServerHealth]]:
+        """Check all servers in parallel, tracking the best healthy one as results arrive"""
+        futures = [self._probe(server) for server in servers]
+        # Position of each future in servers, used to break score ties the
+        # way max() over the list would, regardless of completion order
+        positions: Dict[Future, int] = {}
+        for position, future in enumerate(futures):
+            positions.setdefault(future, position)
+        
+        best: Optional[ServerHealth] = None
+        best_position = len(futures)
+        for future in as_completed(futures):
+            health = future.result()
+            if health.health != HealthStatus.HEALTHY:
+                continue
+            position = positions[future]
+            if (best is None or health.score > best.score
+                    or (health.score == best.score and position < best_position)):
+                best, best_position = health, position
         results = [future.result() for future in futures]
-        return results
+        return results, best
     
     @staticmethod
     def _calculate_score(response_time: float) -> float:
@@ -181,42 +367,187 @@ class HealthChecker:
             return 100 - (response_time - 100) * 0.2
         else:
             return max(1, 100 - response_time * 0.1)
-    
-    def __del__(self):
-        """Cleanup resources"""
-        self.session.close()
-        self.executor.shutdown(wait=False)
+
+
+@dataclass(frozen=True)
+class HealthSnapshot:
+    """Health results published by one poll, with routing data precomputed"""
+    servers: Dict[str, ServerHealth]
+    best: Optional[ServerHealth]
+    # Healthy servers with a positive weight * score, and their running total
+    candidates: List[ServerHealth]
+    cum_weights: List[float]
+    # Encoded /health body and /server bodies by URL, built once per poll
+    health_payload: bytes = b''
+    server_payloads: Dict[str, bytes] = field(default_factory=dict)
 
 
 class LoadBalancer:
     """Main load balancer logic"""
     
-    def __init__(self, servers: List[ServerConfig], health_checker: HealthChecker):
+    def __init__(self, servers: List[ServerConfig], health_checker: HealthChecker,
+                 poll_interval: float = 5):
         self.servers = servers
         self.health_checker = health_checker
+        self.poll_interval = poll_interval
+        # Replaced wholesale on refresh so readers never need the lock
+        self._snapshot = HealthSnapshot({}, None, [], [])
+        self._lock = threading.Lock()
+        self._poller: Optional[threading.Thread] = None
     
-    def get_all_server_health(self) -> List[ServerHealth]:
-        """Get health status for all servers"""
-        return self.health_checker.check_all_servers_parallel(self.servers)
+    def refresh(self) -> List[ServerHealth]:
+        """Probe all servers and publish the results as the latest snapshot"""
+        results, best = self.health_checker.check_all_servers_parallel(self.servers)
+        
+        weights_by_url = {s.url: s.weight for s in self.servers}
+        candidates = [
+            h for h in results
+            if h.health == HealthStatus.HEALTHY and weights_by_url.get(h.url, 0) * h.score > 0
+        ]
+        cum_weights = list(accumulate(weights_by_url[h.url] * h.score for h in candidates))
+        
+        snapshot = HealthSnapshot(
+            servers={h.url: h for h in results},
+            best=best,
+            candidates=candidates,
+            cum_weights=cum_weights,
+            health_payload=self._encode_health_payload(results, best),
+            server_payloads={
+                h.url: self._encode_server_payload(h)
+                for h in results if h.health == HealthStatus.HEALTHY
+            }
+        )
+        with self._lock:
+            self._snapshot = snapshot
+        return results
+    
+    def start_polling(self) -> None:
+        """Start the background thread that keeps the health snapshot fresh"""
+        if self._poller is not None:
+            return
+        self._poller = threading.Thread(
+            target=self._poll_loop,
+            name='health-poller',
+            daemon=True
+        )
+        self._poller.start()
+    
+    def _poll_loop(self) -> None:
+        """Refresh the snapshot every poll_interval seconds"""
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing server health: {e}")
+            time.sleep(self.poll_interval)
+    
+    def _get_snapshot(self) -> HealthSnapshot:
+        """Get the latest snapshot, probing synchronously if no poll has completed yet"""
+        if not self._snapshot.servers:
+            self.refresh()
+        return self._snapshot
     
     def get_best_server(self) -> Optional[ServerHealth]:
         """Get the server with the highest score"""
-        all_servers = self.get_all_server_health()
-        healthy_servers = [
-            s for s in all_servers 
-            if s.health == HealthStatus.HEALTHY
-        ]
+        best_server = self._get_snapshot().best
         
-        if not healthy_servers:
+        if not best_server:
             logger.warning("No healthy servers available")
             return None
         
-        return max(healthy_servers, key=lambda x: x.score)
+        return best_server
+    
+    @staticmethod
+    def _encode_health_payload(results: List[ServerHealth],
+                               best_server: Optional[ServerHealth]) -> bytes:
+        """Encode the /health summary for a set of probe results"""
+        healthy_count = sum(
+            1 for s in results
+            if s.health == HealthStatus.HEALTHY
+        )
+        return orjson.dumps({
+            'status': 'healthy' if healthy_count > 0 else 'degraded',
+            'best_server': orjson.Fragment(best_server.serialized) if best_server else None,
+            'all_servers': [orjson.Fragment(s.serialized) for s in results],
+            'total_servers': len(results),
+            'healthy_servers': healthy_count,
+            'timestamp': datetime.now().isoformat()
+        })
+    
+    @staticmethod
+    def _encode_server_payload(health: ServerHealth) -> bytes:
+        """Encode the /server body routing a client to the given server"""
+        return orjson.dumps({
+            'server': health.name,
+            'server_url': health.url,
+            'health': health.health.value,
+            'score': health.score,
+            'response_time': health.response_time,
+            'last_checked': health.last_checked
+        })
+    
+    def get_health_payload(self) -> bytes:
+        """Get the encoded health summary built by the last poll"""
+        return self._get_snapshot().health_payload
+    
+    def get_server_payload(self, health: ServerHealth) -> bytes:
+        """Get the encoded /server body for a server, prebuilt when it is in the snapshot"""
+        payload = self._get_snapshot().server_payloads.get(health.url)
+        return payload or self._encode_server_payload(health)
+    
+    def pick_p2c(self) -> Optional[ServerHealth]:
+        """Pick the better of two healthy servers sampled by weight * score"""
+        snapshot = self._get_snapshot()
+        
+        if not snapshot.candidates:
+            return None
+        
+        # Sampled with replacement so lower scored servers still get some
+        # traffic; cum_weights lets random.choices bisect the running totals
+        picks = random.choices(snapshot.candidates, cum_weights=snapshot.cum_weights, k=2)
+        return max(picks, key=lambda x: x.score)
+    
+    def get_best_server_with_fallback(self, max_stale: float = 300) -> Optional[ServerHealth]:
+        """Get the best server, falling back to recently healthy ones if none are up"""
+        best_server = self.get_best_server()
+        if best_server:
+            return best_server
+        
+        now = time.time()
+        # Copy first: probe threads may insert new URLs while this iterates
+        last_good = list(self.health_checker.last_good.values())
+        recent = [
+            health for health in last_good
+            if now - health.last_checked_epoch < max_stale
+        ]
+        if not recent:
+            return None
+        
+        logger.warning("Serving last known healthy server")
+        return max(recent, key=lambda x: x.score)
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson"""
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs) -> Response:
+        """Build the response body directly from orjson bytes"""
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype='application/json'
+        )
 
 
 # Initialize Flask app
 app = Flask(__name__)
-app.config['JSON_SORT_KEYS'] = False
+app.json = OrjsonProvider(app)
 
 # Server configuration
 SERVERS = [
@@ -230,16 +561,32 @@ SERVERS = [
     ServerConfig('server8', 'https://4.aimachengine.com'),
 ]
 
+SERVERS_BY_NAME: Dict[str, ServerConfig] = {s.name: s for s in SERVERS}
+
+# Seconds clients and edge caches may reuse a /health response
+HEALTH_CACHE_MAX_AGE = 2
+
 # Initialize components
-health_checker = HealthChecker(timeout=3, cache_ttl=10)
-load_balancer = LoadBalancer(SERVERS, health_checker)
+health_checker = HealthChecker(
+    timeout=3,
+    cache_ttl=2,
+    max_hosts=len(SERVERS),
+    max_workers=max(4, len(SERVERS))
+)
+load_balancer = LoadBalancer(SERVERS, health_checker, poll_interval=5)
+# Started at import, so each server process polls on its own. Under a
+# pre-forking server (e.g. gunicorn --preload) start it after the fork instead.
+load_balancer.start_polling()
 
 
 @app.route('/server')
 def upload_endpoint() -> Tuple[Response, int]:
-    """Return the server with highest score for upload"""
+    """Return a high scoring server for upload, spreading load across them"""
     try:
-        best_server = load_balancer.get_best_server()
+        best_server = (
+            load_balancer.pick_p2c()
+            or load_balancer.get_best_server_with_fallback()
+        )
         
         if not best_server:
             return jsonify({
@@ -248,14 +595,10 @@ def upload_endpoint() -> Tuple[Response, int]:
                 'health': 'unavailable'
             }), 503
         
-        return jsonify({
-            'server': best_server.name,
-            'server_url': best_server.url,
-            'health': best_server.health.value,
-            'score': best_server.score,
-            'response_time': best_server.response_time,
-            'last_checked': best_server.last_checked
-        }), 200
+        return Response(
+            load_balancer.get_server_payload(best_server),
+            mimetype='application/json'
+        ), 200
         
     except Exception as e:
         logger.error(f"Error in upload_endpoint: {e}")
@@ -266,22 +609,11 @@ def upload_endpoint() -> Tuple[Response, int]:
 def health_check() -> Tuple[Response, int]:
     """Enhanced health check endpoint"""
     try:
-        all_servers = load_balancer.get_all_server_health()
-        best_server = load_balancer.get_best_server()
-        
-        healthy_count = sum(
-            1 for s in all_servers 
-            if s.health == HealthStatus.HEALTHY
-        )
-        
-        return jsonify({
-            'status': 'healthy' if healthy_count > 0 else 'degraded',
-            'best_server': best_server.to_dict() if best_server else None,
-            'all_servers': [s.to_dict() for s in all_servers],
-            'total_servers': len(all_servers),
-            'healthy_servers': healthy_count,
-            'timestamp': datetime.now().isoformat()
-        }), 200
+        return Response(
+            load_balancer.get_health_payload(),
+            mimetype='application/json',
+            headers={'Cache-Control': f'public, max-age={HEALTH_CACHE_MAX_AGE}'}
+        ), 200
         
     except Exception as e:
         logger.error(f"Error in health_check: {e}")
@@ -295,16 +627,13 @@ def health_check() -> Tuple[Response, int]:
 def individual_server_health(server_name: str) -> Tuple[Response, int]:
     """Get health status for a specific server"""
     try:
-        server = next(
-            (s for s in SERVERS if s.name == server_name),
-            None
-        )
+        server = SERVERS_BY_NAME.get(server_name)
         
         if not server:
             return jsonify({'error': 'Server not found'}), 404
         
         health = health_checker.check_server(server)
-        return jsonify(health.to_dict()), 200
+        return Response(health.serialized, mimetype='application/json'), 200
         
     except Exception as e:
         logger.error(f"Error checking server {server_name}: {e}")
@@ -325,7 +654,8 @@ def internal_error(error):
 
 
 if __name__ == '__main__':
-    # Production configuration
+    # Development server. The Dockerfile serves load-balancer-app.py under
+    # gunicorn, not this module.
     app.run(
         host='0.0.0.0',
         port=10000,